@@ -1,107 +1,261 @@
+import ijson
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-import json
 import logging
+import os
+import shutil
 
+from concurrent.futures import ThreadPoolExecutor
 # from os import environ
 from os import path
-from typing import Any, Dict, List, Tuple
-
-from parser import Parser
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from parser import (
+    CATEGORIES,
+    description_cache_info,
+    parse_addr,
+    parse_category,
+    parse_description,
+    parse_id,
+    parse_lat,
+    parse_lng,
+    parse_name,
+    parse_opening_hours,
+    parse_phone,
+    parse_verified,
+    parse_website,
+)
 # from translation import Translation
 
 
 POMAGAM_CACHE_FILENAME = '.pomagam_cache.json'
+# last downloaded markers and their ETag/Last-Modified, for conditional GET
+POMAGAM_MARKERS_FILENAME = '.pomagam_markers.json'
+POMAGAM_MARKERS_META_FILENAME = '.pomagam_markers_meta.json'
+# verified pois and invalid markers parsed from the last downloaded markers
+POMAGAM_POIS_FILENAME = '.pomagam_pois.json'
+# hash of the last translation sheet update, to skip unchanged updates
+POMAGAM_TRANSLATION_STATE_FILENAME = '.pomagam_translation_state.json'
 POMAGAM_DATA_DIR = 'pomagam_data'
+# userspace buffer size for output files, keeps write syscalls few and large
+OUTPUT_BUFFERING = 1 << 20
+# threads used to write per-category geojson files concurrently
+CATEGORY_WRITE_WORKERS = 4
 # map_id=1 – production, map_id=2 – tests
 POMAGAM_URL = 'https://pomag.am/index.php' \
               '?rest_route=/wpgmza/v1/markers' \
               '&filter={"map_id":"1"}'
 
 FIELD_PARSER = {
-    'id': Parser.parse_id,
-    'category': Parser.parse_category,
-    'verified': Parser.parse_verified,
-    'lat': Parser.parse_lat,
-    'lng': Parser.parse_lng,
-    'name': Parser.parse_name,
-    'description': Parser.parse_description,
-    'phone': Parser.parse_phone,
-    'addr': Parser.parse_addr,
-    'opening_hours': Parser.parse_opening_hours,
-    'website': Parser.parse_website,
+    'id': parse_id,
+    'category': parse_category,
+    'verified': parse_verified,
+    'lat': parse_lat,
+    'lng': parse_lng,
+    'name': parse_name,
+    'description': parse_description,
+    'phone': parse_phone,
+    'addr': parse_addr,
+    'opening_hours': parse_opening_hours,
+    'website': parse_website,
 }
 
+# Fields whose parsers return None for empty values, so the call can be skipped
+OPTIONAL_FIELDS = frozenset((
+    'description',
+    'phone',
+    'addr',
+    'opening_hours',
+    'website',
+))
+
+# (raw marker key, marker key) pairs
+MARKER_FIELDS = (
+    # meta data
+    ('id', 'id'),
+    ('categories', 'category'),
+
+    # marker data
+    ('title', 'name'),
+    ('address', 'addr'),
+    ('lat', 'lat'),
+    ('lng', 'lng'),
+    ('description', 'description'),
+    ('link', 'website'),
+)
+
+# nested additional fields used for "custom_fields"
+MARKER_CUSTOM_FIELDS = (
+    # meta data
+    ('Czy zweryfikowany?', 'verified'),
+
+    # marker data
+    ('Numer telefonu', 'phone'),
+    ('Godziny otwarcia', 'opening_hours'),
+)
+
+# (connect, read) timeouts in seconds
+POMAGAM_TIMEOUT = (3, 30)
+
+# Module level session, so every download reuses pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+))
+_SESSION.headers.update({
+    'Accept-Encoding': 'gzip',
+    'Connection': 'keep-alive',
+})
+
+
+def load_markers_meta() -> Dict[str, str]:
+    try:
+        with open(POMAGAM_MARKERS_META_FILENAME, 'rb') as f:
+            return orjson.loads(f.read())
+    except Exception as e:
+        logging.error(f'Error with reading markers metadata: {e}')
+        return {}
 
-def download_markers() -> List[Dict[str, Any]]:
-    return requests.get(POMAGAM_URL).json()
 
+def save_markers_meta(meta: Dict[str, str]) -> None:
+    meta_tmp_filename = POMAGAM_MARKERS_META_FILENAME + '.tmp'
+    with open(meta_tmp_filename, 'wb') as f:
+        f.write(orjson.dumps(meta))
+    os.replace(meta_tmp_filename, POMAGAM_MARKERS_META_FILENAME)
 
-def custom_to_dict(custom_fields: List[Dict[str, Any]]) -> Dict[str, Any]:
-    return {field['name']: field['value'] for field in custom_fields}
 
+def load_parsed_pois() -> Optional[Tuple[List[Dict], List[Tuple]]]:
+    try:
+        with open(POMAGAM_POIS_FILENAME, 'rb') as f:
+            parsed = orjson.loads(f.read())
+        return parsed['pois'], parsed['invalid_markers']
+    except Exception as e:
+        logging.error(f'Error with reading parsed pois: {e}')
+        return None
 
-def remap_filter_attributes(
-    raw_markers: List[Dict[str, Any]]
-) -> List[Dict[str, Any]]:
 
+def save_parsed_pois(
+    pois: List[Dict[str, Any]],
+    invalid_markers: List[Tuple[Dict, Dict]]
+) -> None:
+    pois_tmp_filename = POMAGAM_POIS_FILENAME + '.tmp'
+    with open(pois_tmp_filename, 'wb', buffering=OUTPUT_BUFFERING) as f:
+        f.write(orjson.dumps({
+            'pois': pois,
+            'invalid_markers': invalid_markers,
+        }))
+    os.replace(pois_tmp_filename, POMAGAM_POIS_FILENAME)
+
+
+def download_markers() -> Optional[Dict[str, str]]:
     """
-    Raw marker contains 'category' and 'categories' attributes!
-    But they don't have the same value (probably plugin or wordpress fault)
-    So only 'categories' is correct, but it can contain multiple values
-    which will be parsed (or not) to only one, so it's remaped to
-    'category' name anyway.
-    """
-    fields = {
-        # meta data
-        'id': 'id',
-        'categories': 'category',
-
-        # marker data
-        'title': 'name',
-        'address': 'addr',
-        'lat': 'lat',
-        'lng': 'lng',
-        'description': 'description',
-        'link': 'website',
-    }
+    Download markers to POMAGAM_MARKERS_FILENAME with a conditional GET,
+    using ETag/Last-Modified saved by the last successful run.
 
-    # nested additional fields used for "custom_fields"
-    other_fields = {
-        # meta data
-        'Czy zweryfikowany?': 'verified',
+    :return: ETag/Last-Modified of the downloaded markers, to be saved with
+    save_markers_meta once they are processed, or None when markers
+    weren't modified since the last successful run
+    """
+    meta = load_markers_meta()
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    with _SESSION.get(
+        POMAGAM_URL,
+        headers=headers,
+        timeout=POMAGAM_TIMEOUT,
+        stream=True
+    ) as response:
+        if response.status_code == 304:
+            return None
+
+        response.raise_for_status()
+        # let urllib3 undo gzip transfer encoding
+        response.raw.decode_content = True
+        markers_tmp_filename = POMAGAM_MARKERS_FILENAME + '.tmp'
+        with open(
+            markers_tmp_filename,
+            'wb',
+            buffering=OUTPUT_BUFFERING
+        ) as f:
+            shutil.copyfileobj(response.raw, f, OUTPUT_BUFFERING)
+        os.replace(markers_tmp_filename, POMAGAM_MARKERS_FILENAME)
+
+        return {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
 
-        # marker data
-        'Numer telefonu': 'phone',
-        'Godziny otwarcia': 'opening_hours',
-    }
-    markers = []
 
-    for raw_marker in raw_markers:
-        marker = {}
+def read_markers() -> Iterator[Dict[str, Any]]:
+    """
+    Stream downloaded markers one by one, so the whole JSON document
+    is never held in memory.
+    """
+    with open(POMAGAM_MARKERS_FILENAME, 'rb') as f:
+        yield from ijson.items(f, 'item', use_float=True)
 
-        for key, value in fields.items():
-            marker[value] = raw_marker.get(key, None)
 
-        custom_field_data = custom_to_dict(raw_marker['custom_field_data'])
+def custom_to_dict(custom_fields: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {field['name']: field['value'] for field in custom_fields}
 
-        for key, value in other_fields.items():
-            marker[value] = custom_field_data.get(key, None)
 
-        markers.append(marker)
+def remap_marker(raw_marker: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Raw marker contains 'category' and 'categories' attributes!
+    But they don't have the same value (probably plugin or wordpress fault)
+    So only 'categories' is correct, but it can contain multiple values
+    which will be parsed (or not) to only one, so it's remaped to
+    'category' name anyway.
+    """
+    marker = {dst: raw_marker.get(src) for src, dst in MARKER_FIELDS}
+    custom_field_data = custom_to_dict(raw_marker['custom_field_data'])
+    marker.update(
+        (dst, custom_field_data.get(src)) for src, dst in MARKER_CUSTOM_FIELDS
+    )
 
-    return markers
+    return marker
 
 
-def parse_pois(markers: List[Dict[str, Any]]) -> Tuple[List, List]:
-    pois = []
-    invalid_markers = []
+def stream_pois(
+    raw_markers: Iterable[Dict[str, Any]],
+    invalid_markers: List[Tuple[Dict, Dict]],
+    drop_unverified: bool = True
+) -> Iterator[Dict[str, Any]]:
+    """
+    Remap, parse and filter raw markers in a single pass.
+    Markers which failed parsing are appended to invalid_markers
+    as (errors, marker) tuples.
 
-    for marker in markers:
+    :param drop_unverified: yield only verified pois
+    """
+    for raw_marker in raw_markers:
+        marker = remap_marker(raw_marker)
         poi = {}
         errors = {}
 
         for key, value in marker.items():
+            if not value and key in OPTIONAL_FIELDS:
+                poi[key] = None
+                continue
+
             try:
                 poi[key] = FIELD_PARSER[key](value)
 
@@ -111,32 +265,39 @@ def parse_pois(markers: List[Dict[str, Any]]) -> Tuple[List, List]:
 
         if errors:
             invalid_markers.append((errors, marker))
-        else:
-            pois.append(poi)
+            continue
 
-    return pois, invalid_markers
+        if drop_unverified and not poi['verified']:
+            continue
 
+        yield poi
 
-def pois_to_geojson(pois: List[Dict[str, Any]]) -> Dict[str, Any]:
-    geojson = {
-        'type': 'FeatureCollection',
-        'features': []
+
+def poi_to_feature(poi: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'Point',
+            'coordinates': [poi['lng'], poi['lat']]
+        },
+        'properties': {
+            k: v for k, v in poi.items() if k not in ('lng', 'lat')
+        },
     }
 
-    for poi in pois:
-        feature = {
-            'type': 'Feature',
-            'geometry': {
-                'type': 'Point',
-                'coordinates': [poi['lng'], poi['lat']]
-            },
-        }
-        feature['properties'] = {k: v for k, v in poi.items()}
-        del feature['properties']['lng']
-        del feature['properties']['lat']
-        geojson['features'].append(feature)
 
-    return geojson
+def write_geojson(pois: Iterable[Dict[str, Any]], f: BinaryIO) -> None:
+    """
+    Write pois as geojson FeatureCollection to binary file,
+    encoding features one by one instead of building the whole collection
+    in memory first.
+    """
+    f.write(b'{"type":"FeatureCollection","features":[')
+    for i, poi in enumerate(pois):
+        if i:
+            f.write(b',')
+        f.write(orjson.dumps(poi_to_feature(poi)))
+    f.write(b']}')
 
 
 def diff_cache(pois: List[Dict], update: bool = True) -> Dict[str, List[Dict]]:
@@ -154,39 +315,38 @@ def diff_cache(pois: List[Dict], update: bool = True) -> Dict[str, List[Dict]]:
             poi_new['description'] != poi_old['description'],
         ])
 
-    diff = {
-        'created': {},
-        'modified': {},
-        'deleted': {},
-    }
-
     try:
-        with open(POMAGAM_CACHE_FILENAME, 'r') as f:
-            cache = json.load(f)
+        with open(POMAGAM_CACHE_FILENAME, 'rb') as f:
+            cache = orjson.loads(f.read())
     except Exception as e:
         logging.error(f'Error with reading poi cache: {e}')
         cache = {}
 
-    for poi in pois:
-        poi_id = poi['id']
-        if poi_id not in cache:
-            diff['created'][poi_id] = poi
-        else:
-            poi_cached = cache[poi_id]
-            if is_modified(poi, poi_cached):
-                diff['modified'][poi_id] = poi
+    new_cache = {poi['id']: poi for poi in pois}
+    new_ids = new_cache.keys()
+    cached_ids = cache.keys()
 
-            del cache[poi_id]
-
-    diff['deleted'].update(cache)
+    diff = {
+        'created': {
+            poi_id: new_cache[poi_id] for poi_id in new_ids - cached_ids
+        },
+        'modified': {
+            poi_id: new_cache[poi_id] for poi_id in new_ids & cached_ids
+            if is_modified(new_cache[poi_id], cache[poi_id])
+        },
+        'deleted': {
+            poi_id: cache[poi_id] for poi_id in cached_ids - new_ids
+        },
+    }
 
     if update:
         try:
-            new_cache = {
-                poi['id']: poi for poi in pois
-            }
-            with open(POMAGAM_CACHE_FILENAME, 'w', encoding='utf-8') as f:
-                json.dump(new_cache, f, ensure_ascii=False, indent=4)
+            with open(
+                POMAGAM_CACHE_FILENAME,
+                'wb',
+                buffering=OUTPUT_BUFFERING
+            ) as f:
+                f.write(orjson.dumps(new_cache))
         except IOError as e:
             logging.error(f'Error with caching poi: {e}')
             pass
@@ -220,24 +380,17 @@ def update_poi_translation(
     Update poi properties with translated strings
     It won't add lang properties to the poi if the value is empty
     """
-    def clean_record(record: Dict[str, Any]) -> Dict[str, Any]:
-        """
-        Removes empty properties
-        """
-        return {k: v for k, v in record.items() if v}
-
-    translation = {
-        record['id']: clean_record(record) for record in translation_data
-    }
+    translation = {record['id']: record for record in translation_data}
     for poi in pois:
-        poi_id = poi['id']
-        if poi_id in translation:
-            poi.update(translation[poi_id])
+        record = translation.get(poi['id'])
+        if record:
+            # skip empty properties
+            poi.update((k, v) for k, v in record.items() if v)
 
 
 def group_by_category(pois: List[Dict[str, Any]]) -> Dict[str, List[Dict]]:
     categorized_pois = {
-        v: [] for v in Parser.CATEGORIES.values()
+        v: [] for v in CATEGORIES.values()
     }
     for poi in pois:
         categorized_pois[poi['category']].append(poi)
@@ -245,6 +398,19 @@ def group_by_category(pois: List[Dict[str, Any]]) -> Dict[str, List[Dict]]:
     return categorized_pois
 
 
+def save_category_geojson(category: str, pois: List[Dict[str, Any]]) -> None:
+    pomagam_category_filename = path.join(
+        POMAGAM_DATA_DIR,
+        f'pomagam-{category}.geojson'
+    )
+    with open(
+        pomagam_category_filename,
+        'wb',
+        buffering=OUTPUT_BUFFERING
+    ) as f:
+        write_geojson(pois, f)
+
+
 def main():
     logging.basicConfig(
         format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
@@ -253,18 +419,31 @@ def main():
     )
 
     logging.info('Downloading markers from pomag.am ' + POMAGAM_URL)
-    raw_markers = download_markers()
-    logging.info(f'Downloaded: {len(raw_markers)} markers.')
-    markers = remap_filter_attributes(raw_markers)
-    all_pois, invalid_markers = parse_pois(markers)
+    markers_meta = download_markers()
+    parsed = None
+    if markers_meta is None:
+        # only download and parsing are skipped, translation and outputs
+        # below still run, they may change without markers changing
+        logging.info('Markers not modified since last run.')
+        parsed = load_parsed_pois()
+
+    if parsed is None:
+        invalid_markers = []
+        verified_pois = list(stream_pois(read_markers(), invalid_markers))
+        # saved before translation, which adds translated fields to pois
+        save_parsed_pois(verified_pois, invalid_markers)
+    else:
+        verified_pois, invalid_markers = parsed
+
     logging.info(f'Filtered {len(invalid_markers)} invalid markers.')
-    verified_pois = list(filter(lambda x: x['verified'], all_pois))
     logging.info(f'Filtered {len(verified_pois)} verified pois.')
+    logging.debug(f'Description cache: {description_cache_info()}')
     # pois_diff = diff_cache(verified_pois, update=True)
     #
     # tr = Translation(
     #     environ['GOOGLE_API_CREDENTIAL_FILENAME'],
-    #     environ['GOOGLE_API_SPREADSHEET_ID']
+    #     environ['GOOGLE_API_SPREADSHEET_ID'],
+    #     POMAGAM_TRANSLATION_STATE_FILENAME
     # )
     # translation_data = tr.fetch()
     # translation_data = filter_translation(translation_data, pois_diff)
@@ -275,26 +454,26 @@ def main():
     #     ['name', 'description'],
     #     ['pl', 'en', 'ua', 'ru']
     # )
-    # tr.update(to_translate)
+    # tr.update(to_translate, strict=True)
 
     pomagam_all_filename = path.join(POMAGAM_DATA_DIR, 'pomagam.geojson')
-    with open(pomagam_all_filename, 'w', encoding='utf-8') as f:
-        json.dump(
-            pois_to_geojson(verified_pois),
-            f,
-            ensure_ascii=False,
-            indent=4
-        )
+    with open(
+        pomagam_all_filename,
+        'wb',
+        buffering=OUTPUT_BUFFERING
+    ) as f:
+        write_geojson(verified_pois, f)
     logging.info('Saved all poi data to: ' + pomagam_all_filename)
     # Write to multiple files (per category)
     categorized_pois = group_by_category(verified_pois)
-    for category, pois in categorized_pois.items():
-        pomagam_category_filename = path.join(
-            POMAGAM_DATA_DIR,
-            f'pomagam-{category}.geojson'
-        )
-        with open(pomagam_category_filename, 'w', encoding='utf-8') as f:
-            json.dump(pois_to_geojson(pois), f, ensure_ascii=False, indent=4)
+    with ThreadPoolExecutor(max_workers=CATEGORY_WRITE_WORKERS) as executor:
+        futures = [
+            executor.submit(save_category_geojson, category, pois)
+            for category, pois in categorized_pois.items()
+        ]
+        # re-raise errors from worker threads
+        for future in futures:
+            future.result()
 
     categories = ','.join(categorized_pois.keys())
     logging.info(f'Saved data to multiple files per category: {categories}')
@@ -302,11 +481,19 @@ def main():
         POMAGAM_DATA_DIR,
         'pomagam_invalid.json'
     )
-    with open(pomagam_invalid_filename, 'w', encoding='utf-8') as f:
-        json.dump(invalid_markers, f, ensure_ascii=False, indent=4)
+    with open(
+        pomagam_invalid_filename,
+        'wb',
+        buffering=OUTPUT_BUFFERING
+    ) as f:
+        f.write(orjson.dumps(invalid_markers))
 
     logging.info(f'Saved invalid markers to ' + pomagam_invalid_filename)
 
+    # saved last, so a failed run downloads and processes markers again
+    if markers_meta is not None:
+        save_markers_meta(markers_meta)
+
 
 if __name__ == '__main__':
     main()
@@ -1,162 +1,223 @@
-from bleach import clean
+from bleach.sanitizer import Cleaner
+from lxml.etree import XPath
 from lxml.html import document_fromstring
 
 import logging
+import re
 
+from functools import lru_cache
 from typing import Any
 
 
-class Parser:
-    CATEGORIES = {
-        '1': 'charityDropOff',
-        '2': 'accommodation',
-        '3': 'govermentCharity',
-        '4': 'psychologicalAssistance',
-        '5': 'legalAssistance',
-        '6': 'medicalAssistance',
-        '7': 'animalAssistance',
-        '8': 'childcare',
-        '9': 'transport',
-    }
-
-    @staticmethod
-    def parse_id(value: Any) -> str:
-        if not value:
-            raise ValueError('ID cannot be empty!')
-
-        return str(value)
-
-    @staticmethod
-    def parse_category(value: Any) -> str:
-        if not isinstance(value, list):
-            raise ValueError(f'Unexpected category data type: {value}')
-
-        if len(value) > 1:
-            raise ValueError(f'Unexpected multiple categories: {value}')
-
-        # Currently empty should be handled same as '1'
-        if len(value) == 0:
-            return Parser.CATEGORIES['1']
-            # raise ValueError('Category cannot be empty!')
-
-        category_id = value[0]
-        try:
-            return Parser.CATEGORIES[category_id]
-        except Exception:
-            raise ValueError(f'Unexpected category ID: {category_id}')
-
-    @staticmethod
-    def parse_verified(value: Any) -> bool:
-        TRUE_VALUES = {
-            'tak',
-            'zweryfikowany',
-            'zweryfikowane',
-            'zweryfikowana',
-            'zweryfikowano',
-        }
-        FALSE_VALUES = {
-            'nie',
-            'niezweryfikowany',
-            'niezweryfikowana',
-            'niezweryfikowane',
-            'niezweryfikowano',
-        }
-
-        # for now empty value is just False
-        if not value:
-            return False
-            # raise ValueError('Verify cannot be empty!')
-
-        # Remove all whitespace characters and lower
-        clean_value = ''.join(value.strip().split()).lower()
-
-        if clean_value in TRUE_VALUES:
-            return True
-
-        elif clean_value in FALSE_VALUES:
-            return False
-
-        else:
-            raise ValueError(f'Unexpected verified value: {value}')
-
-    @staticmethod
-    def parse_lat(value: Any) -> float:
-        lat = float(value)
-
-        if not (45 < lat < 56):
-            raise ValueError(f'Suspicious latitude: {lat}')
-
-        return lat
-
-    @staticmethod
-    def parse_lng(value: Any) -> float:
-        lng = float(value)
-
-        if not (12 < lng < 30):
-            raise ValueError(f'Suspicious longitude: {lng}')
-
-        return lng
-
-    @staticmethod
-    def parse_name(value: Any) -> str:
-        if not value:
-            raise ValueError('Name cannot be empty!')
-
-        return clean(value, strip=True)
-
-    @staticmethod
-    def parse_description(value: Any) -> str:
-        if not value:
-            return None
-
-        try:
-            doc = document_fromstring(value)
-            # Add new lines to end of div/br elements
-            for elem in doc.xpath('//*[self::div or self::br]'):
-                elem.tail = '\n' + elem.tail if elem.tail else '\n'
-
-            # Add new line with '-' char to list elements
-            for li in doc.xpath('*//li'):
-                li.text = '\n- ' + li.text if li.text else '\n'
+CATEGORIES = {
+    '1': 'charityDropOff',
+    '2': 'accommodation',
+    '3': 'govermentCharity',
+    '4': 'psychologicalAssistance',
+    '5': 'legalAssistance',
+    '6': 'medicalAssistance',
+    '7': 'animalAssistance',
+    '8': 'childcare',
+    '9': 'transport',
+}
+
+# Rough bounding box of Poland, (min, max) exclusive
+LAT_BOUNDS = (45.0, 56.0)
+LNG_BOUNDS = (12.0, 30.0)
+
+_VERIFIED_TRUE_VALUES = frozenset((
+    'tak',
+    'zweryfikowany',
+    'zweryfikowane',
+    'zweryfikowana',
+    'zweryfikowano',
+))
+_VERIFIED_FALSE_VALUES = frozenset((
+    'nie',
+    'niezweryfikowany',
+    'niezweryfikowana',
+    'niezweryfikowane',
+    'niezweryfikowano',
+))
+
+# Normalized 'verified' field value -> parsed value
+_VERIFIED_LUT = dict.fromkeys(_VERIFIED_TRUE_VALUES, True)
+_VERIFIED_LUT.update(dict.fromkeys(_VERIFIED_FALSE_VALUES, False))
+
+
+# Compiled once and reused for every description
+_BLOCK_XPATH = XPath('//*[self::div or self::br]')
+_LIST_ITEM_XPATH = XPath('*//li')
+_CLEANER = Cleaner(strip=True)
+
+# Characters which bleach escapes, strips or replaces (C0 control
+# characters become '?'), strings without them come out of the cleaner
+# unchanged
+_HTML_SPECIAL_CHARS = re.compile('[<>&\r\0\x01-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _clean(value: str) -> str:
+    if not _HTML_SPECIAL_CHARS.search(value):
+        return value
+
+    return _CLEANER.clean(value)
+
+
+# Many markers share the same boilerplate description
+@lru_cache(maxsize=4096)
+def _parse_description_html(value: str) -> str:
+    try:
+        doc = document_fromstring(value)
+        # Add new lines to end of div/br elements
+        for elem in _BLOCK_XPATH(doc):
+            elem.tail = '\n' + elem.tail if elem.tail else '\n'
+
+        # Add new line with '-' char to list elements
+        for li in _LIST_ITEM_XPATH(doc):
+            li.text = '\n- ' + li.text if li.text else '\n'
+
+        value = ''.join(doc.itertext())
+        value = value.replace(', -', ',\n-')  # fix some lists
+
+    except Exception as e:
+        logging.error(f'Parsing description error: {e}')
+        pass
+
+    return _clean(value)
+
+
+def parse_id(value: Any) -> str:
+    if not value:
+        raise ValueError('ID cannot be empty!')
+
+    return str(value)
+
+
+def parse_category(value: Any) -> str:
+    if not isinstance(value, list):
+        raise ValueError(f'Unexpected category data type: {value}')
+
+    if len(value) > 1:
+        raise ValueError(f'Unexpected multiple categories: {value}')
+
+    # Currently empty should be handled same as '1'
+    if len(value) == 0:
+        return CATEGORIES['1']
+        # raise ValueError('Category cannot be empty!')
+
+    category_id = value[0]
+    try:
+        return CATEGORIES[category_id]
+    except (KeyError, TypeError):
+        raise ValueError(f'Unexpected category ID: {category_id}')
+
+
+def parse_verified(value: Any) -> bool:
+    # for now empty value is just False
+    if not value:
+        return False
+        # raise ValueError('Verify cannot be empty!')
 
-            value = doc.text_content()
-            value = value.replace(', -', ',\n-')  # fix some lists
+    # Remove all whitespace characters and casefold
+    verified = _VERIFIED_LUT.get(''.join(value.split()).casefold())
 
-        except Exception as e:
-            logging.error(f'Parsing description error: {e}')
-            pass
+    if verified is None:
+        raise ValueError(f'Unexpected verified value: {value}')
 
-        return clean(value, strip=True)
-
-    @staticmethod
-    def parse_phone(value: Any) -> str:
-        if not value:
-            return None
-
-        if str(value).strip().lower() in ('brak', 'nie'):
-            return None
-
-        return clean(value, strip=True)
+    return verified
 
-    @staticmethod
-    def parse_addr(value: Any) -> str:
-        if not value:
-            return None
 
-        if str(value).strip().lower() in ('brak', 'nie'):
-            return None
+def parse_lat(value: Any) -> float:
+    lat = float(value)
+    lat_min, lat_max = LAT_BOUNDS
 
-        return clean(value, strip=True)
+    if not (lat_min < lat < lat_max):
+        raise ValueError(f'Suspicious latitude: {lat}')
 
-    @staticmethod
-    def parse_website(value: Any) -> str:
-        # Currently not used
-        return str(value) if value else None
+    return lat
 
-    @staticmethod
-    def parse_opening_hours(value: Any) -> str:
-        # Currently not used
-        if not value:
-            return None
 
-        return clean(value, strip=True)
+def parse_lng(value: Any) -> float:
+    lng = float(value)
+    lng_min, lng_max = LNG_BOUNDS
+
+    if not (lng_min < lng < lng_max):
+        raise ValueError(f'Suspicious longitude: {lng}')
+
+    return lng
+
+
+def parse_name(value: Any) -> str:
+    if not value:
+        raise ValueError('Name cannot be empty!')
+
+    return _clean(value)
+
+
+def parse_description(value: Any) -> str:
+    if not value:
+        return None
+
+    return _parse_description_html(value)
+
+
+def description_cache_info():
+    """
+    Hit/miss statistics of parsed descriptions cache
+    """
+    return _parse_description_html.cache_info()
+
+
+def parse_phone(value: Any) -> str:
+    if not value:
+        return None
+
+    if str(value).strip().lower() in ('brak', 'nie'):
+        return None
+
+    return _clean(value)
+
+
+def parse_addr(value: Any) -> str:
+    if not value:
+        return None
+
+    if str(value).strip().lower() in ('brak', 'nie'):
+        return None
+
+    return _clean(value)
+
+
+def parse_website(value: Any) -> str:
+    # Currently not used
+    return str(value) if value else None
+
+
+def parse_opening_hours(value: Any) -> str:
+    # Currently not used
+    if not value:
+        return None
+
+    return _clean(value)
+
+
+class Parser:
+    """
+    Parser functions grouped in a namespace, kept for backwards compatibility
+    """
+    CATEGORIES = CATEGORIES
+    LAT_BOUNDS = LAT_BOUNDS
+    LNG_BOUNDS = LNG_BOUNDS
+
+    parse_id = staticmethod(parse_id)
+    parse_category = staticmethod(parse_category)
+    parse_verified = staticmethod(parse_verified)
+    parse_lat = staticmethod(parse_lat)
+    parse_lng = staticmethod(parse_lng)
+    parse_name = staticmethod(parse_name)
+    parse_description = staticmethod(parse_description)
+    description_cache_info = staticmethod(description_cache_info)
+    parse_phone = staticmethod(parse_phone)
+    parse_addr = staticmethod(parse_addr)
+    parse_website = staticmethod(parse_website)
+    parse_opening_hours = staticmethod(parse_opening_hours)
@@ -1,6 +1,57 @@
 import gspread
+from gspread.urls import DRIVE_FILES_API_V3_URL
+from gspread.utils import absolute_range_name, numericise_all, rowcol_to_a1
+import orjson
+from requests.adapters import HTTPAdapter
 
-from typing import Any, Dict, List
+import hashlib
+import logging
+import random
+import time
+
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+
+# rows per range sent in one batch update request
+UPDATE_CHUNK_ROWS = 1000
+
+# API errors worth retrying: rate limit and temporary server errors
+RETRY_STATUS_CODES = frozenset((429, 500, 503))
+RETRY_ATTEMPTS = 6
+RETRY_MAX_DELAY = 32
+
+
+def _with_backoff(func: Callable, *args, **kwargs) -> Any:
+    """
+    Call Google API function, retrying rate limited and temporarily failed
+    requests with exponential backoff and random jitter
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+
+        except gspread.exceptions.APIError as error:
+            retryable = error.response.status_code in RETRY_STATUS_CODES
+            if not retryable or attempt == RETRY_ATTEMPTS - 1:
+                raise
+
+            time.sleep(min(2 ** attempt, RETRY_MAX_DELAY) + random.random())
+
+
+@lru_cache(maxsize=32)
+def _row_getter(headers: Tuple[str, ...]) -> Callable:
+    """
+    Compile function returning row values ordered by headers,
+    with missing keys filled by given empty value. Headers are embedded
+    as repr() literals, so the evaluated code is only dict.get calls.
+    """
+    cells = ', '.join(f'row.get({header!r}, empty)' for header in headers)
+
+    return eval(f'lambda row, empty: [{cells}]')
 
 
 class Translation:
@@ -11,9 +62,37 @@ class Translation:
     It uses google Spreadsheet API to give opportunity to share it with
     translators group.
     """
-    def __init__(self, credential_filename, spreadsheet_key):
+    def __init__(
+        self,
+        credential_filename,
+        spreadsheet_key,
+        update_state_filename=None,
+        fetch_cache_size=0
+    ):
         self.gc = gspread.service_account(filename=credential_filename)
-        self.spreadsheet = self.gc.open_by_key(spreadsheet_key)
+        # keep TLS connections to Google APIs alive between requests
+        self.gc.session.mount(
+            'https://',
+            HTTPAdapter(pool_connections=4, pool_maxsize=20)
+        )
+        self.gc.session.headers['Connection'] = 'keep-alive'
+        self.spreadsheet = _with_backoff(self.gc.open_by_key, spreadsheet_key)
+        # first worksheet, used when no worksheet is given
+        self._default_worksheet = _with_backoff(
+            self.spreadsheet.get_worksheet, 0
+        )
+        # worksheet id -> header row, saves a request on every update
+        self._headers_cache: Dict[int, List[str]] = {}
+        # LRU of fetch arguments -> (spreadsheet version, records),
+        # checking the version costs a Drive request, so it's off when 0
+        self.fetch_cache_size = fetch_cache_size
+        self._fetch_cache: 'OrderedDict[Tuple, Tuple[str, List[Dict]]]' = (
+            OrderedDict()
+        )
+        # file keeping {worksheet id: [payload hash, spreadsheet version]}
+        # of the last update, to skip unchanged updates in later runs;
+        # if none, every update is written
+        self.update_state_filename = update_state_filename
 
     @staticmethod
     def create_data_to_translate(
@@ -27,13 +106,16 @@ class Translation:
         :param lang_codes: to generate columns with specific languages
         Example: ['pl', 'en'] produces ['name', 'name:pl', 'name:en'] columns
         """
+        # column names depend only on keys and lang_codes
+        lang_pairs = [
+            (key, [f'{key}:{lang}' for lang in lang_codes]) for key in keys
+        ]
         translation_data = []
         for obj in data:
             record = {'id': obj['id']}
-            for key in keys:
+            for key, lang_keys in lang_pairs:
                 record[key] = obj[key]
-                for lang in lang_codes:
-                    lang_key = f'{key}:{lang}'
+                for lang_key in lang_keys:
                     record[lang_key] = obj.get(lang_key, '')
 
             translation_data.append(record)
@@ -55,29 +137,165 @@ class Translation:
             {'col1': val1, 'col2': val2},
             {'col1': val1, 'col2': val2},
         ]
+        With fetch_cache_size set, records are cached until
+        the spreadsheet changes, so they shouldn't be modified in place.
         """
         if worksheet is None:
-            worksheet = self.spreadsheet.sheet1
+            worksheet = self._default_worksheet
+
+        if self.fetch_cache_size:
+            cache_key = (worksheet.id, head, tuple(numericise_ignore))
+            version = self._spreadsheet_version()
+            cached = self._fetch_cache.get(cache_key)
+            if cached is not None and cached[0] == version:
+                self._fetch_cache.move_to_end(cache_key)
+                return cached[1]
 
-        return worksheet.get_all_records(
-            head=head,
-            numericise_ignore=numericise_ignore
+        values = _with_backoff(
+            self.spreadsheet.values_get,
+            absolute_range_name(worksheet.title),
+            params={'valueRenderOption': 'FORMATTED_VALUE'}
+        ).get('values', [])
+        records = list(
+            self._iter_records(worksheet, values, head, numericise_ignore)
         )
+        if self.fetch_cache_size:
+            self._fetch_cache[cache_key] = (version, records)
+            self._fetch_cache.move_to_end(cache_key)
+            while len(self._fetch_cache) > self.fetch_cache_size:
+                self._fetch_cache.popitem(last=False)
+
+        return records
+
+    def _spreadsheet_version(self) -> str:
+        """
+        Drive file version, it's increased by every change of the spreadsheet
+        (headRevisionId isn't available for Google Sheets files)
+        """
+        response = _with_backoff(
+            self.gc.request,
+            'get',
+            f'{DRIVE_FILES_API_V3_URL}/{self.spreadsheet.id}',
+            params={'fields': 'version', 'supportsAllDrives': True}
+        )
+
+        return response.json()['version']
+
+    def fetch_many(
+        self,
+        worksheets: List[gspread.Worksheet],
+        head=1,
+        numericise_ignore=['all']
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Read several worksheets with a single batch request
+        :param head: row number with headers
+        :param numericise_ignore: ignore converting text to number
+        :return: records of each worksheet (same format as fetch)
+        in the same order as given worksheets
+        """
+        value_ranges = _with_backoff(
+            self.spreadsheet.values_batch_get,
+            [
+                absolute_range_name(worksheet.title)
+                for worksheet in worksheets
+            ],
+            params={'valueRenderOption': 'FORMATTED_VALUE'}
+        )['valueRanges']
+
+        return [
+            list(self._iter_records(
+                worksheet,
+                value_range.get('values', []),
+                head,
+                numericise_ignore
+            ))
+            for worksheet, value_range in zip(worksheets, value_ranges)
+        ]
+
+    def iter_records(
+        self,
+        worksheet: gspread.Worksheet = None,
+        head=1,
+        numericise_ignore=['all']
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Same as fetch, but records are created lazily one by one
+        while iterating. Worksheet values are read once, when it's called.
+        :param worksheet: if none it uses default 'sheet1' worksheet
+        :param head: row number with headers
+        :param numericise_ignore: ignore converting text to number
+        """
+        if worksheet is None:
+            worksheet = self._default_worksheet
+
+        values = _with_backoff(
+            self.spreadsheet.values_get,
+            absolute_range_name(worksheet.title),
+            params={'valueRenderOption': 'FORMATTED_VALUE'}
+        ).get('values', [])
+
+        return self._iter_records(worksheet, values, head, numericise_ignore)
+
+    def _iter_records(
+        self,
+        worksheet: gspread.Worksheet,
+        values: List[List[Any]],
+        head: int,
+        numericise_ignore: List[Any]
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Convert worksheet values to records keyed by the header row
+        """
+        if len(values) < head:
+            return
+
+        keys = values[head - 1]
+        # same check as get_all_records
+        if len(keys) != len(set(keys)):
+            raise gspread.exceptions.GSpreadException(
+                'headers must be uniques'
+            )
+
+        width = len(keys)
+
+        # header row is already here, a following update won't re-read it
+        if head == 1:
+            headers = list(keys)
+            Translation._rstrip_list(headers)
+            self._headers_cache[worksheet.id] = headers
+
+        # API skips trailing empty cells, so short rows are padded
+        if numericise_ignore == ['all']:
+            # values are already formatted strings, nothing to convert
+            for row in islice(values, head, None):
+                yield dict(zip(keys, row + [''] * (width - len(row))))
+            return
+
+        for row in islice(values, head, None):
+            yield dict(zip(keys, numericise_all(
+                row + [''] * (width - len(row)),
+                ignore=numericise_ignore
+            )))
 
     @staticmethod
     def _rstrip_list(data: List[Any]):
         """
         Removes trailing non True value from list
         """
-        while data and not data[-1]:
-            data.pop()
+        end = len(data)
+        while end and not data[end - 1]:
+            end -= 1
+
+        del data[end:]
 
     def update(
         self,
         data: List[Dict[str, Any]],
         worksheet: gspread.Worksheet = None,
         head=1,
-        empty_value=''
+        empty_value='',
+        strict=False
     ):
         """
         Update whole spreadsheet with given data
@@ -85,16 +303,100 @@ class Translation:
         :param head: row number with headers
         :param empty_value: value which will be used to fill cells with missing
         key: value pairs in data
+        :param strict: data rows are expected to contain all header keys
+        (e.g. created by create_data_to_translate), which allows faster
+        lookups. If some key is missing, it falls back to empty_value filling.
         """
         if worksheet is None:
-            worksheet = self.spreadsheet.sheet1
+            worksheet = self._default_worksheet
+
+        headers = self._headers_cache.get(worksheet.id)
+        if headers is None:
+            headers = _with_backoff(worksheet.row_values, 1)
+            Translation._rstrip_list(headers)
+            self._headers_cache[worksheet.id] = headers
+
+        rows = None
+        # itemgetter returns a bare value, not a tuple, for a single key
+        if strict and len(headers) > 1:
+            # all header keys of a row are looked up in C by itemgetter
+            get_cells = itemgetter(*headers)
+            try:
+                rows = [list(get_cells(row)) for row in data]
+            except KeyError:
+                pass
+
+        if rows is None:
+            get_row = _row_getter(tuple(headers))
+            rows = [get_row(row, empty_value) for row in data]
 
-        headers = worksheet.row_values(1)
-        Translation._rstrip_list(headers)
+        ordered_data = [list(headers)]
+        ordered_data.extend(rows)
 
-        ordered_data = [[header for header in headers]]
-        for row in data:
-            ordered_row = [row.get(header, empty_value) for header in headers]
-            ordered_data.append(ordered_row)
+        # skip writing when nobody changed the sheet since the same update
+        state = None
+        if self.update_state_filename is not None:
+            state = self._load_update_state()
+            payload_hash = hashlib.blake2b(
+                repr(ordered_data).encode(),
+                digest_size=16
+            ).hexdigest()
+            last_update = state.get(str(worksheet.id))
+            if last_update is not None and last_update[0] == payload_hash:
+                if last_update[1] == self._spreadsheet_version():
+                    logging.info(f'Worksheet {worksheet.title} is up to date.')
+                    return
+
+        ranges = []
+        for start in range(0, len(ordered_data), UPDATE_CHUNK_ROWS):
+            chunk = ordered_data[start:start + UPDATE_CHUNK_ROWS]
+            first = rowcol_to_a1(start + 1, 1)
+            last = rowcol_to_a1(start + len(chunk), len(headers))
+            ranges.append({
+                'range': absolute_range_name(
+                    worksheet.title,
+                    f'{first}:{last}'
+                ),
+                'majorDimension': 'ROWS',
+                'values': chunk,
+            })
+
+        _with_backoff(self.spreadsheet.values_batch_update, body={
+            'valueInputOption': 'RAW',
+            'data': ranges,
+        })
+        if state is not None:
+            # Version is read after the write, so an edit made by someone
+            # else between these two requests is recorded as ours and
+            # the next update with the same payload would skip over it.
+            state[str(worksheet.id)] = [
+                payload_hash,
+                self._spreadsheet_version()
+            ]
+            self._save_update_state(state)
+
+    def _load_update_state(self) -> Dict[str, List[str]]:
+        try:
+            with open(self.update_state_filename, 'rb') as f:
+                return orjson.loads(f.read())
+        except Exception as e:
+            logging.error(f'Error with reading update state: {e}')
+            return {}
+
+    def _save_update_state(self, state: Dict[str, List[str]]):
+        try:
+            with open(self.update_state_filename, 'wb') as f:
+                f.write(orjson.dumps(state))
+        except IOError as e:
+            logging.error(f'Error with saving update state: {e}')
+
+    def invalidate_headers(self, worksheet: gspread.Worksheet = None):
+        """
+        Forget cached header row, has to be called after the header row
+        of the worksheet was changed outside of this class
+        :param worksheet: if none it uses default 'sheet1' worksheet
+        """
+        if worksheet is None:
+            worksheet = self._default_worksheet
 
-        worksheet.update(ordered_data)
+        self._headers_cache.pop(worksheet.id, None)